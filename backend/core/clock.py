@@ -0,0 +1,17 @@
+from datetime import datetime, timezone
+import threading
+import time
+
+_lock = threading.Lock()
+_last_second = 0
+_last_iso = ""
+
+def utcnow_iso() -> str:
+    """Current UTC time as an ISO-8601 string, formatted at most once per second"""
+    global _last_second, _last_iso
+    second = int(time.time())
+    with _lock:
+        if second != _last_second:
+            _last_second = second
+            _last_iso = datetime.fromtimestamp(second, timezone.utc).isoformat()
+        return _last_iso
@@ -1,5 +1,6 @@
+from functools import cached_property
 from pydantic_settings import BaseSettings
-from typing import Optional
+from typing import Optional, List
 import os
 from pathlib import Path
 
@@ -13,6 +14,7 @@ class Settings(BaseSettings):
     
     # Redis
     REDIS_URL: str = "redis://localhost:6379"
+    REDIS_POOL_SIZE: int = 50
     
     # JWT
     JWT_SECRET_KEY: str = "your-secret-key-change-in-production-use-openssl-rand-hex-32"
@@ -23,10 +25,20 @@ class Settings(BaseSettings):
     # OTP
     OTP_EXPIRE_MINUTES: int = 5
     OTP_MAX_ATTEMPTS: int = 3
+    OTP_PEPPER: str = "your-otp-pepper-change-in-production-use-openssl-rand-hex-32"
     
     # Rate Limiting
     RATE_LIMIT_OTP_PER_HOUR: int = 5
     RATE_LIMIT_LOGIN_PER_HOUR: int = 10
+    # Sliding window (sorted set + Lua) is exact; fixed window is one INCR
+    # and needs Redis 7.0+ (falls back to sliding window on older servers)
+    RATE_LIMIT_SLIDING_WINDOW: bool = True
+    # Keys the hash that compacts rate-limit identifiers into short Redis keys
+    RATE_LIMIT_KEY_SECRET: str = "change-in-production"
+    
+    # Logging
+    DEBUG: bool = True
+    LOG_LEVEL: str = "INFO"  # use WARNING in production
     
     # CORS
     CORS_ORIGINS: str = "*"
@@ -34,5 +46,20 @@ class Settings(BaseSettings):
     class Config:
         env_file = ENV_FILE
         case_sensitive = True
+    
+    # Derived values, computed once rather than on every token operation /
+    # at import sites. Properties, not fields, so they can't be set from the
+    # environment or .env.
+    @cached_property
+    def JWT_SECRET_KEY_BYTES(self) -> bytes:
+        return self.JWT_SECRET_KEY.encode()
+    
+    @cached_property
+    def OTP_PEPPER_BYTES(self) -> bytes:
+        return self.OTP_PEPPER.encode()
+    
+    @cached_property
+    def CORS_ORIGINS_LIST(self) -> List[str]:
+        return [origin.strip() for origin in self.CORS_ORIGINS.split(',')]
 
 settings = Settings()
\ No newline at end of file
@@ -0,0 +1,11 @@
+from typing import List, Optional
+
+def build_identifiers(username: str, email: Optional[str] = None, phone: Optional[str] = None) -> List[str]:
+    """
+    Lowercased lookup keys for a user (single multikey index instead of $or).
+    The index is unique, so these are also what makes usernames, emails and
+    phones unique case-insensitively and across each other.
+    Shared by the API and scripts/backfill_identifiers.py, so keep this module
+    free of settings and database imports.
+    """
+    return list(dict.fromkeys(value.lower() for value in (username, email, phone) if value))
@@ -1,10 +1,55 @@
 import bcrypt
-from datetime import datetime, timedelta, timezone
-from typing import Optional, Dict, Any
+from datetime import timedelta
+from typing import Optional, Dict, Any, List, Tuple, Union
 import jwt
 from .config import settings
-import secrets
+import base64
 import hashlib
+import hmac
+import json
+import re
+import secrets
+import threading
+import time
+import os
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+# Reused JWS codec so token creation doesn't rebuild it per call
+_JWS = jwt.PyJWS(algorithms=[settings.JWT_ALGORITHM])
+
+# Tokens have a fixed shape, so with HS256 the header is a constant and the
+# payload can be templated; anything needing JSON escaping goes through _JWS.
+_HS256 = settings.JWT_ALGORITHM == "HS256"
+_HS256_HEADER_B64 = base64.urlsafe_b64encode(b'{"alg":"HS256","typ":"JWT"}').rstrip(b"=")
+_JSON_ESCAPE_CHARS = re.compile(r'["\\\x00-\x1f]')
+
+# Cache of decoded tokens keyed on the raw token string. Valid tokens map to
+# their payload, known-bad tokens map to the error message so repeated
+# garbage doesn't pay for HMAC verification again.
+_TOKEN_CACHE_MAXSIZE = 10_000
+_TOKEN_CACHE_TTL = settings.ACCESS_TOKEN_EXPIRE_MINUTES * 60
+_INVALID_TOKEN_TTL = 60
+_token_cache: Dict[str, Tuple[float, Any]] = {}
+_token_cache_lock = threading.Lock()
+
+# BLAKE2b accepts keys up to 64 bytes
+_TOKEN_HASH_KEY = settings.JWT_SECRET_KEY_BYTES[:64]
+
+# bcrypt is CPU-bound and would block the event loop, so it runs on a
+# dedicated pool that doesn't compete with the default executor.
+_password_executor = ThreadPoolExecutor(
+    max_workers=os.cpu_count() or 1,
+    thread_name_prefix="bcrypt"
+)
+
+# Pool of CSPRNG bytes for OTP generation, refilled in batches so that one
+# os.urandom call serves many OTPs. Each OTP consumes 3 bytes (24 bits).
+_OTP_BATCH_SIZE = 256
+_OTP_LIMIT = (2 ** 24 // 1_000_000) * 1_000_000
+_otp_pool = bytearray()
+_otp_idx = 0
+_otp_lock = threading.Lock()
 
 def hash_password(password: str) -> str:
     """Hash a password using bcrypt"""
@@ -26,49 +71,142 @@ def verify_password(plain_password: str, hashed_password: str) -> bool:
     hashed_bytes = hashed_password.encode('utf-8')
     return bcrypt.checkpw(password_bytes, hashed_bytes)
 
+async def hash_password_async(password: str) -> str:
+    """Hash a password without blocking the event loop"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_password_executor, hash_password, password)
+
+async def verify_password_async(plain_password: str, hashed_password: str) -> bool:
+    """Verify a password without blocking the event loop"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_password_executor, verify_password, plain_password, hashed_password)
+
+def _encode_jwt(payload: Dict[str, Any]) -> str:
+    body = json.dumps(payload, separators=(",", ":")).encode()
+    return _JWS.encode(body, settings.JWT_SECRET_KEY_BYTES, algorithm=settings.JWT_ALGORITHM)
+
+def _b64url(data: bytes) -> bytes:
+    return base64.urlsafe_b64encode(data).rstrip(b"=")
+
+def _is_plain(value: Any) -> bool:
+    """True if the value can be embedded in a JSON string without escaping"""
+    return isinstance(value, str) and not _JSON_ESCAPE_CHARS.search(value)
+
+def _sign_hs256(body: str) -> str:
+    """Sign a pre-serialized JWT payload with the constant HS256 header"""
+    signing_input = _HS256_HEADER_B64 + b"." + _b64url(body.encode())
+    signature = hmac.new(settings.JWT_SECRET_KEY_BYTES, signing_input, hashlib.sha256).digest()
+    return (signing_input + b"." + _b64url(signature)).decode()
+
 def create_access_token(data: Dict[str, Any], expires_delta: Optional[timedelta] = None) -> str:
     """Create JWT access token"""
-    to_encode = data.copy()
-    
     if expires_delta:
-        expire = datetime.now(timezone.utc) + expires_delta
+        lifetime = expires_delta.total_seconds()
     else:
-        expire = datetime.now(timezone.utc) + timedelta(minutes=settings.ACCESS_TOKEN_EXPIRE_MINUTES)
+        lifetime = settings.ACCESS_TOKEN_EXPIRE_MINUTES * 60
+    exp = int(time.time() + lifetime)
     
-    to_encode.update({"exp": expire, "type": "access"})
-    encoded_jwt = jwt.encode(to_encode, settings.JWT_SECRET_KEY, algorithm=settings.JWT_ALGORITHM)
-    return encoded_jwt
+    # Fast path for the {"sub", "role"} shape every caller uses
+    sub, role = data.get("sub"), data.get("role")
+    if _HS256 and len(data) == 2 and _is_plain(sub) and _is_plain(role):
+        return _sign_hs256(f'{{"sub":"{sub}","role":"{role}","exp":{exp},"type":"access"}}')
+    
+    return _encode_jwt({**data, "exp": exp, "type": "access"})
 
 def create_refresh_token(data: Dict[str, Any]) -> str:
     """Create JWT refresh token"""
-    to_encode = data.copy()
-    expire = datetime.now(timezone.utc) + timedelta(days=settings.REFRESH_TOKEN_EXPIRE_DAYS)
-    to_encode.update({"exp": expire, "type": "refresh"})
-    encoded_jwt = jwt.encode(to_encode, settings.JWT_SECRET_KEY, algorithm=settings.JWT_ALGORITHM)
-    return encoded_jwt
+    lifetime = settings.REFRESH_TOKEN_EXPIRE_DAYS * 24 * 60 * 60
+    exp = int(time.time() + lifetime)
+    # Random token id: without it two refresh tokens issued to the same user
+    # in the same second are identical (and their stored hashes collide)
+    jti = secrets.token_hex(16)
+    
+    # Fast path for the {"sub"} shape every caller uses
+    sub = data.get("sub")
+    if _HS256 and len(data) == 1 and _is_plain(sub):
+        return _sign_hs256(f'{{"sub":"{sub}","exp":{exp},"type":"refresh","jti":"{jti}"}}')
+    
+    return _encode_jwt({**data, "exp": exp, "type": "refresh", "jti": jti})
+
+def _cache_token(token: str, deadline: float, value: Any) -> None:
+    with _token_cache_lock:
+        _token_cache.pop(token, None)
+        if len(_token_cache) >= _TOKEN_CACHE_MAXSIZE:
+            _token_cache.pop(next(iter(_token_cache)))
+        _token_cache[token] = (deadline, value)
 
 def decode_token(token: str) -> Dict[str, Any]:
     """Decode and verify JWT token"""
+    now = time.time()
+    with _token_cache_lock:
+        entry = _token_cache.pop(token, None)
+        if entry is not None and entry[0] > now:
+            # Re-insert to keep the most recently used tokens at the end
+            _token_cache[token] = entry
+        else:
+            entry = None
+    
+    if entry is not None:
+        value = entry[1]
+        if isinstance(value, str):
+            raise ValueError(value)
+        return dict(value)
+    
     try:
-        payload = jwt.decode(token, settings.JWT_SECRET_KEY, algorithms=[settings.JWT_ALGORITHM])
-        return payload
+        payload = jwt.decode(token, settings.JWT_SECRET_KEY_BYTES, algorithms=[settings.JWT_ALGORITHM])
     except jwt.ExpiredSignatureError:
+        _cache_token(token, now + _INVALID_TOKEN_TTL, "Token has expired")
         raise ValueError("Token has expired")
-    except jwt.JWTError:
+    except jwt.InvalidTokenError:
+        _cache_token(token, now + _INVALID_TOKEN_TTL, "Invalid token")
         raise ValueError("Invalid token")
+    
+    _cache_token(token, min(payload["exp"], now + _TOKEN_CACHE_TTL), payload)
+    return dict(payload)
+
+def invalidate_token(token: str) -> None:
+    """Drop a token from the decode cache (e.g. on logout)"""
+    with _token_cache_lock:
+        _token_cache.pop(token, None)
 
 def generate_otp() -> str:
     """Generate a 6-digit OTP"""
-    return f"{secrets.randbelow(1000000):06d}"
+    global _otp_pool, _otp_idx
+    with _otp_lock:
+        while True:
+            if _otp_idx >= len(_otp_pool):
+                _otp_pool = bytearray(os.urandom(3 * _OTP_BATCH_SIZE))
+                _otp_idx = 0
+            value = int.from_bytes(_otp_pool[_otp_idx:_otp_idx + 3], "big")
+            _otp_idx += 3
+            # Reject values above the largest multiple of 10^6 to avoid modulo bias
+            if value < _OTP_LIMIT:
+                return f"{value % 1_000_000:06d}"
 
-def hash_otp(otp: str) -> str:
-    """Hash OTP using SHA256"""
-    return hashlib.sha256(otp.encode()).hexdigest()
+def hash_otp(otp: str) -> bytes:
+    """
+    Hash OTP using HMAC-SHA256 with a server-side pepper (raw digest, stored
+    as BSON binary). OTPs are low-entropy but attempt-capped and short-lived,
+    so a fast keyed hash is enough; the pepper protects against DB leaks.
+    """
+    return hmac.new(settings.OTP_PEPPER_BYTES, otp.encode(), hashlib.sha256).digest()
 
-def verify_otp_hash(otp: str, otp_hash: str) -> bool:
-    """Verify OTP against its hash"""
-    return hash_otp(otp) == otp_hash
+def verify_otp_hash(otp: str, otp_hash: Union[bytes, str]) -> bool:
+    """Verify OTP against its hash in constant time"""
+    if isinstance(otp_hash, str):
+        # OTPs stored before the switch to raw digests hold unkeyed hex SHA-256
+        return hmac.compare_digest(hashlib.sha256(otp.encode()).digest(), bytes.fromhex(otp_hash))
+    return hmac.compare_digest(hash_otp(otp), otp_hash)
 
 def hash_token(token: str) -> str:
-    """Hash refresh token for storage"""
-    return hashlib.sha256(token.encode()).hexdigest()
\ No newline at end of file
+    """Hash refresh token for storage (keyed BLAKE2b)"""
+    return hashlib.blake2b(token.encode(), key=_TOKEN_HASH_KEY, digest_size=32).hexdigest()
+
+def token_hash_candidates(token: str) -> List[str]:
+    """
+    Hashes a stored refresh token may have been saved under.
+    Tokens issued before the switch to BLAKE2b were stored as plain SHA-256;
+    the legacy hash can be dropped once those have expired
+    (REFRESH_TOKEN_EXPIRE_DAYS).
+    """
+    return [hash_token(token), hashlib.sha256(token.encode()).hexdigest()]
\ No newline at end of file
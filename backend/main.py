@@ -0,0 +1,21 @@
+"""
+Production entrypoint: runs the app on uvloop + httptools with one worker
+per CPU core, so bcrypt hashing (see core.security) parallelizes across
+processes while each event loop handles the Mongo/Redis IO.
+
+Usage (from the backend directory):
+    python main.py
+"""
+import os
+
+import uvicorn
+
+if __name__ == "__main__":
+    uvicorn.run(
+        "server:app",
+        host=os.environ.get("HOST", "0.0.0.0"),
+        port=int(os.environ.get("PORT", "8000")),
+        loop="uvloop",
+        http="httptools",
+        workers=int(os.environ.get("WEB_CONCURRENCY", os.cpu_count() or 1))
+    )
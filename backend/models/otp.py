@@ -12,8 +12,9 @@ class OTPVerify(BaseModel):
 
 class OTPInDB(BaseModel):
     target: str
-    otp_hash: str
+    otp_hash: bytes
     purpose: str
     attempts: int = 0
-    created_at: str
-    expires_at: str
\ No newline at end of file
+    created_at: datetime
+    expires_at: datetime
+    expires_at_ts: int
\ No newline at end of file
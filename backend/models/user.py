@@ -19,6 +19,7 @@ class UserInDB(BaseModel):
     is_verified: bool = False
     created_at: str
     updated_at: str
+    last_login_at: Optional[str] = None
 
 class UserOut(BaseModel):
     username: str
@@ -0,0 +1,63 @@
+"""
+One-shot migration: populate the `identifiers` lookup field on existing users
+and build its unique index.
+
+Identifiers are lowercased, so existing users whose username/email/phone only
+differ by case (or where one user's username equals another's email) would
+collide. Those conflicts are reported and the index is not built until they
+are resolved by hand.
+
+Usage (from the backend directory):
+    python scripts/backfill_identifiers.py
+"""
+from pathlib import Path
+import os
+import sys
+
+from dotenv import load_dotenv
+from pymongo import MongoClient, UpdateOne
+
+ROOT_DIR = Path(__file__).parent.parent
+load_dotenv(ROOT_DIR / '.env')
+
+# Same normalization the API uses for signup and login lookups
+sys.path.insert(0, str(ROOT_DIR))
+from core.identifiers import build_identifiers  # noqa: E402
+
+
+def main():
+    client = MongoClient(os.environ['MONGO_URL'])
+    db = client[os.environ['DB_NAME']]
+    
+    owners = {}
+    conflicts = {}
+    operations = []
+    for user in db.users.find({}, {"username": 1, "email": 1, "phone": 1, "identifiers": 1}):
+        identifiers = build_identifiers(user.get("username"), user.get("email"), user.get("phone"))
+        for identifier in identifiers:
+            if identifier in owners:
+                conflicts.setdefault(identifier, [owners[identifier]]).append(user["username"])
+            else:
+                owners[identifier] = user["username"]
+        if user.get("identifiers") != identifiers:
+            operations.append(UpdateOne({"_id": user["_id"]}, {"$set": {"identifiers": identifiers}}))
+    
+    if conflicts:
+        print("Conflicting identifiers (resolve these, then re-run):")
+        for identifier, usernames in sorted(conflicts.items()):
+            print(f"  {identifier}: {', '.join(usernames)}")
+        client.close()
+        sys.exit(1)
+    
+    if operations:
+        result = db.users.bulk_write(operations, ordered=False)
+        print(f"Backfilled identifiers for {result.modified_count} users")
+    else:
+        print("No users to backfill")
+    
+    db.users.create_index("identifiers", unique=True, sparse=True)
+    client.close()
+
+
+if __name__ == "__main__":
+    main()
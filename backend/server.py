@@ -1,9 +1,13 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, Response, Request
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, Query, status, Response, Request
+from fastapi.responses import ORJSONResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import MongoClient, ReturnDocument, UpdateOne, InsertOne
+from pymongo.errors import DuplicateKeyError
 import os
+import asyncio
 import logging
 from pathlib import Path
 from datetime import datetime, timedelta, timezone
@@ -16,10 +20,12 @@ from models.token import TokenResponse, RefreshTokenRequest
 
 # Import core
 from core.config import settings
+from core.clock import utcnow_iso
+from core.identifiers import build_identifiers
 from core.security import (
-    hash_password, verify_password,
+    hash_password_async, verify_password_async,
     create_access_token, create_refresh_token,
-    decode_token, hash_token
+    decode_token, invalidate_token, hash_token, token_hash_candidates
 )
 
 # Import services
@@ -31,14 +37,21 @@ load_dotenv(ROOT_DIR / '.env')
 
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+# tz_aware so BSON dates (e.g. OTP expiry) come back as aware UTC datetimes
+client = AsyncIOMotorClient(mongo_url, tz_aware=True)
 db = client[os.environ['DB_NAME']]
 
+# Synchronous client for hot point lookups, run via asyncio.to_thread;
+# cheaper than Motor's per-op overhead for tiny indexed find_one calls.
+# Motor remains in use for writes and cursors.
+sync_client = MongoClient(mongo_url, maxPoolSize=50, tz_aware=True)
+sync_db = sync_client[os.environ['DB_NAME']]
+
 # Initialize services
 otp_service = OTPService(db)
 
 # Create the main app without a prefix
-app = FastAPI(title="Authentication System")
+app = FastAPI(title="Authentication System", default_response_class=ORJSONResponse)
 
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
@@ -48,12 +61,20 @@ security = HTTPBearer()
 
 # Configure logging
 logging.basicConfig(
-    level=logging.INFO,
+    level=settings.LOG_LEVEL,
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
 logger = logging.getLogger(__name__)
 
 
+# ============================================================================
+# HELPERS
+# ============================================================================
+
+# Fields returned to clients; keeps password hashes and lookup keys off the wire
+USER_OUT_PROJECTION = {"_id": 0, **{field: 1 for field in UserOut.model_fields}}
+
+
 # ============================================================================
 # DEPENDENCIES
 # ============================================================================
@@ -71,7 +92,9 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
         if not username:
             raise HTTPException(status_code=401, detail="Invalid token")
         
-        user = await db.users.find_one({"username": username})
+        user = await asyncio.to_thread(
+            sync_db.users.find_one, {"username": username}, {"password_hash": 0}
+        )
         if not user:
             raise HTTPException(status_code=401, detail="User not found")
         
@@ -118,28 +141,11 @@ async def signup(user_data: UserCreate, request: Request):
                 detail="Too many signup attempts. Please try again later."
             )
         
-        # Check if username already exists
-        existing_user = await db.users.find_one({"username": user_data.username})
-        if existing_user:
-            raise HTTPException(status_code=400, detail="Username already exists")
-        
-        # Check if email already exists (if provided)
-        if user_data.email:
-            existing_email = await db.users.find_one({"email": user_data.email})
-            if existing_email:
-                raise HTTPException(status_code=400, detail="Email already registered")
-        
-        # Check if phone already exists (if provided)
-        if user_data.phone:
-            existing_phone = await db.users.find_one({"phone": user_data.phone})
-            if existing_phone:
-                raise HTTPException(status_code=400, detail="Phone already registered")
-        
         # Hash password
-        password_hash = hash_password(user_data.password)
+        password_hash = await hash_password_async(user_data.password)
         
         # Create user document
-        now = datetime.now(timezone.utc).isoformat()
+        now = utcnow_iso()
         user_doc = {
             "username": user_data.username,
             "password_hash": password_hash,
@@ -155,15 +161,39 @@ async def signup(user_data: UserCreate, request: Request):
             user_doc["email"] = user_data.email
         if user_data.phone:
             user_doc["phone"] = user_data.phone
+        user_doc["identifiers"] = build_identifiers(
+            user_data.username, user_data.email, user_data.phone
+        )
         
-        # Insert user
-        result = await db.users.insert_one(user_doc)
+        # Insert user; the unique username/email/phone/identifiers indexes
+        # are the authoritative uniqueness check
+        try:
+            result = await db.users.insert_one(user_doc)
+        except DuplicateKeyError as e:
+            details = e.details or {}
+            key_pattern = details.get("keyPattern", {})
+            # For the identifiers index, keyValue holds the lowercased value that clashed
+            clash = details.get("keyValue", {}).get("identifiers")
+            if "username" in key_pattern or clash == user_data.username.lower():
+                detail = "Username already exists"
+            elif "email" in key_pattern or (user_data.email and clash == user_data.email.lower()):
+                detail = "Email already registered"
+            elif "phone" in key_pattern or (user_data.phone and clash == user_data.phone.lower()):
+                detail = "Phone already registered"
+            else:
+                detail = "Username already exists"
+            raise HTTPException(status_code=400, detail=detail)
         
         # Send OTP for verification
         target = user_data.email or user_data.phone or user_data.username
         target_type = "email" if user_data.email else "phone" if user_data.phone else "username"
         
-        success, message = await otp_service.create_and_send_otp(target, "signup", target_type)
+        try:
+            success, message = await otp_service.create_and_send_otp(target, "signup", target_type)
+        except BaseException:
+            # Unexpected OTP failure: don't leave an unverifiable user behind
+            await db.users.delete_one({"_id": result.inserted_id})
+            raise
         
         if not success:
             # Rollback user creation if OTP sending fails
@@ -203,28 +233,20 @@ async def verify_signup(otp_data: OTPVerify):
         
         # Mark user as verified
         # Find user by email, phone, or username
-        user = await db.users.find_one({
-            "$or": [
-                {"email": otp_data.target},
-                {"phone": otp_data.target},
-                {"username": otp_data.target}
-            ]
-        })
-        
-        if not user:
-            raise HTTPException(status_code=404, detail="User not found")
-        
-        # Update user verification status
-        await db.users.update_one(
-            {"_id": user["_id"]},
+        user = await db.users.find_one_and_update(
+            {"identifiers": otp_data.target.lower()},
             {
                 "$set": {
                     "is_verified": True,
-                    "updated_at": datetime.now(timezone.utc).isoformat()
+                    "updated_at": utcnow_iso()
                 }
-            }
+            },
+            projection={"_id": 1}
         )
         
+        if not user:
+            raise HTTPException(status_code=404, detail="User not found")
+        
         return {
             "message": "Account verified successfully. You can now login.",
             "verified": True
@@ -258,13 +280,9 @@ async def login_password(login_data: UserLogin, request: Request):
             )
         
         # Find user by username, email, or phone
-        user = await db.users.find_one({
-            "$or": [
-                {"username": login_data.identifier},
-                {"email": login_data.identifier},
-                {"phone": login_data.identifier}
-            ]
-        })
+        user = await asyncio.to_thread(
+            sync_db.users.find_one, {"identifiers": login_data.identifier.lower()}
+        )
         
         if not user:
             raise HTTPException(status_code=401, detail="Invalid credentials")
@@ -277,7 +295,7 @@ async def login_password(login_data: UserLogin, request: Request):
             )
         
         # Verify password
-        if not verify_password(login_data.password, user["password_hash"]):
+        if not await verify_password_async(login_data.password, user["password_hash"]):
             raise HTTPException(status_code=401, detail="Invalid credentials")
         
         # Send 2FA OTP
@@ -319,14 +337,13 @@ async def login_verify_otp(otp_data: OTPVerify, response: Response, request: Req
         if not success:
             raise HTTPException(status_code=400, detail=message)
         
-        # Find user
-        user = await db.users.find_one({
-            "$or": [
-                {"email": otp_data.target},
-                {"phone": otp_data.target},
-                {"username": otp_data.target}
-            ]
-        })
+        # Find user and record the login
+        user = await db.users.find_one_and_update(
+            {"identifiers": otp_data.target.lower()},
+            {"$set": {"last_login_at": utcnow_iso()}},
+            projection={"username": 1, "role": 1},
+            return_document=ReturnDocument.AFTER
+        )
         
         if not user:
             raise HTTPException(status_code=404, detail="User not found")
@@ -386,10 +403,9 @@ async def refresh_tokens(refresh_data: RefreshTokenRequest, response: Response):
         username = payload.get("sub")
         
         # Check if refresh token exists and is not revoked
-        token_hash = hash_token(token)
-        stored_token = await db.refresh_tokens.find_one({
+        stored_token = await asyncio.to_thread(sync_db.refresh_tokens.find_one, {
             "user_id": username,
-            "refresh_token_hash": token_hash,
+            "refresh_token_hash": {"$in": token_hash_candidates(token)},
             "revoked": False
         })
         
@@ -410,13 +426,8 @@ async def refresh_tokens(refresh_data: RefreshTokenRequest, response: Response):
         new_access_token = create_access_token({"sub": user["username"], "role": user["role"]})
         new_refresh_token = create_refresh_token({"sub": user["username"]})
         
-        # Revoke old refresh token
-        await db.refresh_tokens.update_one(
-            {"_id": stored_token["_id"]},
-            {"$set": {"revoked": True}}
-        )
-        
-        # Store new refresh token
+        # Rotate: revoke the old refresh token and store the new one in a
+        # single round-trip
         now = datetime.now(timezone.utc)
         new_refresh_token_doc = {
             "user_id": user["username"],
@@ -425,7 +436,10 @@ async def refresh_tokens(refresh_data: RefreshTokenRequest, response: Response):
             "expires_at": (now + timedelta(days=settings.REFRESH_TOKEN_EXPIRE_DAYS)).isoformat(),
             "revoked": False
         }
-        await db.refresh_tokens.insert_one(new_refresh_token_doc)
+        await db.refresh_tokens.bulk_write([
+            UpdateOne({"_id": stored_token["_id"]}, {"$set": {"revoked": True}}),
+            InsertOne(new_refresh_token_doc)
+        ], ordered=True)
         
         # Update cookie
         response.set_cookie(
@@ -454,17 +468,21 @@ async def refresh_tokens(refresh_data: RefreshTokenRequest, response: Response):
 async def logout(
     refresh_data: RefreshTokenRequest,
     response: Response,
-    user: dict = Depends(get_current_user)
+    user: dict = Depends(get_current_user),
+    credentials: HTTPAuthorizationCredentials = Depends(security)
 ):
     """Logout user by revoking refresh token"""
     try:
-        token_hash = hash_token(refresh_data.refresh_token)
+        invalidate_token(credentials.credentials)
+        invalidate_token(refresh_data.refresh_token)
+        
+        token_hashes = token_hash_candidates(refresh_data.refresh_token)
         
         # Revoke refresh token
         await db.refresh_tokens.update_many(
             {
                 "user_id": user["username"],
-                "refresh_token_hash": token_hash
+                "refresh_token_hash": {"$in": token_hashes}
             },
             {"$set": {"revoked": True}}
         )
@@ -486,7 +504,7 @@ async def logout(
 @api_router.get("/users/me", response_model=UserOut)
 async def get_current_user_info(user: dict = Depends(get_current_user)):
     """Get current user information"""
-    return UserOut(
+    return UserOut.model_construct(
         username=user["username"],
         email=user.get("email"),
         phone=user.get("phone"),
@@ -502,22 +520,23 @@ async def get_current_user_info(user: dict = Depends(get_current_user)):
 # ============================================================================
 
 @api_router.get("/admin/users", response_model=List[UserOut])
-async def get_all_users(admin: dict = Depends(get_current_admin)):
-    """Admin: Get all users"""
+async def get_all_users(
+    skip: int = Query(0, ge=0),
+    limit: int = Query(1000, ge=1, le=1000),
+    admin: dict = Depends(get_current_admin)
+):
+    """Admin: Get all users (paginated, oldest first)"""
     try:
-        users = await db.users.find().to_list(1000)
-        return [
-            UserOut(
-                username=user["username"],
-                email=user.get("email"),
-                phone=user.get("phone"),
-                role=user["role"],
-                is_active=user["is_active"],
-                is_verified=user["is_verified"],
-                created_at=user["created_at"]
-            )
-            for user in users
-        ]
+        cursor = db.users.find({}, projection=USER_OUT_PROJECTION)
+        # created_at has one-second resolution; _id breaks ties so pages
+        # neither repeat nor skip users
+        cursor = cursor.sort([("created_at", 1), ("_id", 1)]).skip(skip).limit(limit)
+        
+        # Documents come from our own collection, skip re-validation
+        users = []
+        async for user in cursor:
+            users.append(UserOut.model_construct(**user))
+        return users
     except Exception as e:
         logger.error(f"Get users error: {e}")
         raise HTTPException(status_code=500, detail="Failed to fetch users")
@@ -527,16 +546,21 @@ async def get_all_users(admin: dict = Depends(get_current_admin)):
 async def get_admin_stats(admin: dict = Depends(get_current_admin)):
     """Admin: Get system statistics"""
     try:
-        total_users = await db.users.count_documents({})
-        verified_users = await db.users.count_documents({"is_verified": True})
-        admin_users = await db.users.count_documents({"role": "admin"})
-        customer_users = await db.users.count_documents({"role": "customer"})
+        # Single pass over the collection for all counts
+        pipeline = [{
+            "$facet": {
+                "total_users": [{"$count": "n"}],
+                "verified_users": [{"$match": {"is_verified": True}}, {"$count": "n"}],
+                "admin_users": [{"$match": {"role": "admin"}}, {"$count": "n"}],
+                "customer_users": [{"$match": {"role": "customer"}}, {"$count": "n"}]
+            }
+        }]
+        [counts] = await db.users.aggregate(pipeline).to_list(1)
         
+        # $count emits nothing for an empty match, so default to 0
         return {
-            "total_users": total_users,
-            "verified_users": verified_users,
-            "admin_users": admin_users,
-            "customer_users": customer_users
+            name: result[0]["n"] if result else 0
+            for name, result in counts.items()
         }
     except Exception as e:
         logger.error(f"Get stats error: {e}")
@@ -553,7 +577,7 @@ async def get_customer_profile(user: dict = Depends(get_current_user)):
     if user["role"] != "customer":
         raise HTTPException(status_code=403, detail="Customer access required")
     
-    return UserOut(
+    return UserOut.model_construct(
         username=user["username"],
         email=user.get("email"),
         phone=user.get("phone"),
@@ -573,7 +597,7 @@ async def health_check():
     """Health check endpoint"""
     return {
         "status": "healthy",
-        "timestamp": datetime.now(timezone.utc).isoformat()
+        "timestamp": utcnow_iso()
     }
 
 
@@ -583,7 +607,7 @@ app.include_router(api_router)
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
-    allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
+    allow_origins=settings.CORS_ORIGINS_LIST,
     allow_methods=["*"],
     allow_headers=["*"],
 )
@@ -601,22 +625,47 @@ async def startup_event():
     # Connect to Redis
     await rate_limiter.connect()
     
-    # Create indexes
-    try:
-        await db.users.create_index("username", unique=True)
-        await db.users.create_index("email", unique=True, sparse=True)
-        await db.users.create_index("phone", unique=True, sparse=True)
+    # Create indexes; each is attempted on its own so one failing build
+    # (e.g. existing duplicates) doesn't skip the rest
+    indexes = [
+        (db.users, "username", {"unique": True}),
+        (db.users, "email", {"unique": True, "sparse": True}),
+        (db.users, "phone", {"unique": True, "sparse": True}),
+        # Sparse so users not yet backfilled (scripts/backfill_identifiers.py)
+        # don't collide on a missing value
+        (db.users, "identifiers", {"unique": True, "sparse": True}),
+        (db.users, [("created_at", 1), ("_id", 1)], {}),
+        
+        # One live OTP per target and purpose
+        (db.otps, [("target", 1), ("purpose", 1)], {"unique": True}),
         
         # TTL index for OTPs (auto-delete expired OTPs)
-        await db.otps.create_index("expires_at", expireAfterSeconds=0)
-        
-        # Index for refresh tokens
-        await db.refresh_tokens.create_index("user_id")
-        await db.refresh_tokens.create_index("expires_at", expireAfterSeconds=0)
-        
-        logger.info("Database indexes created successfully")
+        (db.otps, "expires_at", {"expireAfterSeconds": 0}),
+        
+        # Indexes for refresh tokens: the hash is a single-key probe for
+        # /auth/refresh, (user_id, revoked) serves logout and per-user queries
+        (db.refresh_tokens, "refresh_token_hash", {"unique": True}),
+        (db.refresh_tokens, [("user_id", 1), ("revoked", 1)], {}),
+        (db.refresh_tokens, "expires_at", {"expireAfterSeconds": 0}),
+    ]
+    failed = 0
+    for collection, keys, options in indexes:
+        try:
+            await collection.create_index(keys, **options)
+        except Exception as e:
+            failed += 1
+            logger.warning(f"Index creation warning on {collection.name} {keys}: {e}")
+    
+    try:
+        # Superseded by the (user_id, revoked) compound index
+        info = await db.refresh_tokens.index_information()
+        if "user_id_1_revoked_1" in info and "user_id_1" in info:
+            await db.refresh_tokens.drop_index("user_id_1")
     except Exception as e:
-        logger.warning(f"Index creation warning (may already exist): {e}")
+        logger.warning(f"Index drop warning: {e}")
+    
+    if not failed:
+        logger.info("Database indexes created successfully")
     
     logger.info("Application started successfully")
 
@@ -629,7 +678,8 @@ async def shutdown_event():
     # Close Redis connection
     await rate_limiter.close()
     
-    # Close MongoDB connection
+    # Close MongoDB connections
     client.close()
+    sync_client.close()
     
     logger.info("Application shut down successfully")
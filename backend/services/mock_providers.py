@@ -1,20 +1,18 @@
 import logging
+from core.config import settings
 
 logger = logging.getLogger(__name__)
 
+class ProviderError(Exception):
+    """Raised when a provider fails to deliver an OTP"""
+
 class MockEmailProvider:
     """Mock email provider that logs to console"""
     
     async def send_otp(self, email: str, otp: str, purpose: str):
         """Send OTP via email (mock - prints to console)"""
-        logger.info(f"\n{'='*60}")
-        logger.info(f"📧 EMAIL OTP - {purpose.upper()}")
-        logger.info(f"{'='*60}")
-        logger.info(f"To: {email}")
-        logger.info(f"OTP Code: {otp}")
-        logger.info(f"Purpose: {purpose}")
-        logger.info(f"Valid for: 5 minutes")
-        logger.info(f"{'='*60}\n")
+        # OTP codes are only written to the log in debug mode
+        logger.info("EMAIL OTP to=%s purpose=%s code=%s", email, purpose, otp if settings.DEBUG else "***")
         return True
 
 class MockSMSProvider:
@@ -22,14 +20,8 @@ class MockSMSProvider:
     
     async def send_otp(self, phone: str, otp: str, purpose: str):
         """Send OTP via SMS (mock - prints to console)"""
-        logger.info(f"\n{'='*60}")
-        logger.info(f"📱 SMS OTP - {purpose.upper()}")
-        logger.info(f"{'='*60}")
-        logger.info(f"To: {phone}")
-        logger.info(f"OTP Code: {otp}")
-        logger.info(f"Purpose: {purpose}")
-        logger.info(f"Valid for: 5 minutes")
-        logger.info(f"{'='*60}\n")
+        # OTP codes are only written to the log in debug mode
+        logger.info("SMS OTP to=%s purpose=%s code=%s", phone, purpose, otp if settings.DEBUG else "***")
         return True
 
 # Singleton instances
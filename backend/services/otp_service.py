@@ -1,13 +1,24 @@
 from datetime import datetime, timedelta, timezone
+import asyncio
+import re
+import time
 from typing import Optional, Tuple
 from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import ReturnDocument, DeleteMany, InsertOne
+from pymongo.errors import DuplicateKeyError, PyMongoError
 from core.security import generate_otp, hash_otp, verify_otp_hash
 from core.config import settings
-from services.mock_providers import email_provider, sms_provider
+from services.mock_providers import email_provider, sms_provider, ProviderError
 import logging
 
 logger = logging.getLogger(__name__)
 
+_UTC = timezone.utc
+
+# Delivery channel per target type, plus auto-detection for the rest
+_PROVIDERS = {"email": email_provider.send_otp, "phone": sms_provider.send_otp}
+_AUTO_CHANNEL = re.compile(r"@|^\+").search
+
 class OTPService:
     def __init__(self, db: AsyncIOMotorDatabase):
         self.db = db
@@ -24,7 +35,7 @@ class OTPService:
             otp_hash = hash_otp(otp)
             
             # Store OTP
-            now = datetime.now(timezone.utc)
+            now = datetime.now(_UTC)
             expires_at = now + timedelta(minutes=settings.OTP_EXPIRE_MINUTES)
             
             otp_doc = {
@@ -32,69 +43,136 @@ class OTPService:
                 "otp_hash": otp_hash,
                 "purpose": purpose,
                 "attempts": 0,
-                "created_at": now.isoformat(),
-                "expires_at": expires_at.isoformat()
+                "created_at": now,
+                "expires_at": expires_at,  # BSON date for the TTL index
+                "expires_at_ts": int(expires_at.timestamp())  # for cheap checks
             }
             
-            # Delete any existing OTPs for this target and purpose
-            await self.collection.delete_many({"target": target, "purpose": purpose})
+            # Upsert (atomic per target/purpose via the unique index) and send
+            # concurrently; the provider doesn't need the DB write to finish.
+            # Providers must be safe to retry: if the store fails the user
+            # still received a code and will simply request another one.
+            store_result, send_result = await asyncio.gather(
+                self._store_otp(target, purpose, otp_doc),
+                self._send_otp(target, otp, purpose, target_type),
+                return_exceptions=True
+            )
             
-            # Insert new OTP
-            await self.collection.insert_one(otp_doc)
-            
-            # Send OTP via appropriate channel
-            if target_type == "email" or "@" in target:
-                await email_provider.send_otp(target, otp, purpose)
-            elif target_type == "phone" or target.startswith("+"):
-                await sms_provider.send_otp(target, otp, purpose)
-            else:
-                # If username, we need to look up user's email/phone
-                # For now, just log to console
-                logger.info(f"OTP for {target}: {otp}")
+            if isinstance(send_result, BaseException):
+                if not isinstance(store_result, BaseException):
+                    # Compensate: don't leave a verifiable OTP nobody received
+                    await self.collection.delete_one(
+                        {"target": target, "purpose": purpose, "otp_hash": otp_hash}
+                    )
+                raise send_result
+            if isinstance(store_result, BaseException):
+                raise store_result
             
             return True, "OTP sent successfully"
         
-        except Exception as e:
-            logger.error(f"Error creating/sending OTP: {e}")
+        except (PyMongoError, ProviderError) as e:
+            logger.error("Error creating/sending OTP: %s", e)
             return False, f"Failed to send OTP: {str(e)}"
     
+    async def _store_otp(self, target: str, purpose: str, otp_doc: dict):
+        """Replace the OTP for this target and purpose"""
+        try:
+            await self.collection.replace_one(
+                {"target": target, "purpose": purpose},
+                otp_doc,
+                upsert=True
+            )
+        except DuplicateKeyError:
+            # Concurrent upserts for the same target can race on the unique
+            # index; fall back to delete + insert in a single round-trip
+            await self.collection.bulk_write([
+                DeleteMany({"target": target, "purpose": purpose}),
+                InsertOne(otp_doc)
+            ], ordered=True)
+    
+    async def _send_otp(self, target: str, otp: str, purpose: str, target_type: str):
+        """Send OTP via appropriate channel"""
+        send = _PROVIDERS.get(target_type)
+        if send is None:
+            # Username targets: fall back to what the target looks like
+            match = _AUTO_CHANNEL(target)
+            if match:
+                send = _PROVIDERS["email" if match.group() == "@" else "phone"]
+        
+        if send is not None:
+            await send(target, otp, purpose)
+        else:
+            # If username, we need to look up user's email/phone
+            # For now, just log to console
+            # OTP codes are only written to the log in debug mode
+            logger.info("OTP for %s: %s", target, otp if settings.DEBUG else "***")
+    
+    @staticmethod
+    def _expires_at_ts(otp_doc: dict) -> float:
+        """Expiry as epoch seconds, including OTPs stored before expires_at_ts"""
+        expires_at_ts = otp_doc.get("expires_at_ts")
+        if expires_at_ts is not None:
+            return expires_at_ts
+        
+        # Older documents only have expires_at, as a BSON date or an ISO string
+        expires_at = otp_doc["expires_at"]
+        if isinstance(expires_at, str):
+            expires_at = datetime.fromisoformat(expires_at)
+        return expires_at.timestamp()
+    
     async def verify_otp(self, target: str, otp: str, purpose: str) -> Tuple[bool, str]:
         """Verify OTP against stored hash"""
+        max_attempts = settings.OTP_MAX_ATTEMPTS
         try:
-            # Find OTP document
-            otp_doc = await self.collection.find_one({
-                "target": target,
-                "purpose": purpose
-            })
+            # Claim an attempt atomically so concurrent guesses can't both
+            # see the last remaining attempt
+            otp_doc = await self.collection.find_one_and_update(
+                {
+                    "target": target,
+                    "purpose": purpose,
+                    "attempts": {"$lt": max_attempts}
+                },
+                {"$inc": {"attempts": 1}},
+                projection={"otp_hash": 1, "attempts": 1, "expires_at_ts": 1, "expires_at": 1},
+                return_document=ReturnDocument.AFTER
+            )
             
             if not otp_doc:
-                return False, "No OTP found for this target"
+                # Either there is no OTP or its attempts are used up
+                exhausted = await self.collection.find_one(
+                    {"target": target, "purpose": purpose},
+                    {"_id": 1}
+                )
+                if not exhausted:
+                    return False, "No OTP found for this target"
+                # A resend keeps the _id, so only delete while still exhausted
+                await self.collection.delete_one(
+                    {"_id": exhausted["_id"], "attempts": {"$gte": max_attempts}}
+                )
+                return False, "Maximum OTP attempts exceeded"
             
-            # Check if expired
-            expires_at = datetime.fromisoformat(otp_doc["expires_at"])
-            if datetime.now(timezone.utc) > expires_at:
-                await self.collection.delete_one({"_id": otp_doc["_id"]})
+            # Check if expired (the TTL index on expires_at removes the
+            # document in the background, so no delete here)
+            if int(time.time()) > self._expires_at_ts(otp_doc):
                 return False, "OTP has expired"
             
-            # Check attempts
-            if otp_doc["attempts"] >= settings.OTP_MAX_ATTEMPTS:
-                await self.collection.delete_one({"_id": otp_doc["_id"]})
-                return False, "Maximum OTP attempts exceeded"
-            
             # Verify OTP
             if verify_otp_hash(otp, otp_doc["otp_hash"]):
-                # OTP is correct, delete it
-                await self.collection.delete_one({"_id": otp_doc["_id"]})
+                # OTP is correct, consume it. Only the request whose delete
+                # removes the document succeeds, so a code can't be used twice
+                # by concurrent verifies. Matching the hash keeps a code resent
+                # in the meantime (same _id) alive.
+                result = await self.collection.delete_one(
+                    {"_id": otp_doc["_id"], "otp_hash": otp_doc["otp_hash"]}
+                )
+                if result.deleted_count != 1:
+                    return False, "OTP has already been used"
                 return True, "OTP verified successfully"
             else:
-                # Increment attempts
-                await self.collection.update_one(
-                    {"_id": otp_doc["_id"]},
-                    {"$inc": {"attempts": 1}}
-                )
-                remaining = settings.OTP_MAX_ATTEMPTS - (otp_doc["attempts"] + 1)
+                # attempts already includes this one
+                remaining = max_attempts - otp_doc["attempts"]
                 return False, f"Invalid OTP. {remaining} attempts remaining"
         
-        except Exception as e:
-            logger.error(f"Error verifying OTP: {e}")
+        except PyMongoError as e:
+            logger.error("Error verifying OTP: %s", e)
             return False, f"Failed to verify OTP: {str(e)}"
\ No newline at end of file
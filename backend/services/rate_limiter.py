@@ -1,34 +1,244 @@
 import redis.asyncio as redis
-from datetime import datetime, timedelta
-from typing import Tuple
+from redis.exceptions import NoScriptError
+from collections import OrderedDict
+from typing import Dict, List, Tuple
 from core.config import settings
+import hashlib
 import logging
+import secrets
+import time
 
 logger = logging.getLogger(__name__)
 
+# Rolling-window limiter over a sorted set: drop expired entries, count,
+# and record the request in one atomic server-side call.
+# KEYS[1] = bucket, ARGV = [now_ms, window_ms, limit, member]
+# Returns {allowed, remaining, retry_after_ms}
+SLIDING_WINDOW_LUA = """
+local key = KEYS[1]
+local now = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+local limit = tonumber(ARGV[3])
+
+redis.call('ZREMRANGEBYSCORE', key, 0, now - window)
+local count = redis.call('ZCARD', key)
+if count >= limit then
+    -- Blocked until the oldest request in the window ages out
+    local oldest = redis.call('ZRANGE', key, 0, 0, 'WITHSCORES')
+    return {0, 0, tonumber(oldest[2]) + window - now}
+end
+
+redis.call('ZADD', key, now, ARGV[4])
+redis.call('PEXPIRE', key, window)
+return {1, limit - count - 1, 0}
+"""
+
+# Several fixed windows for one subject packed into a single hash: for each
+# window the hash holds `name` (count) and `name:w` (current window index).
+# Counts only advance if every window allows the request.
+# KEYS[1] = hash, ARGV = [now_ms, ttl_ms, n, name_1, limit_1, window_ms_1, ...]
+# Returns {allowed, remaining_1, ..., remaining_n}
+MULTI_WINDOW_LUA = """
+local key = KEYS[1]
+local now = tonumber(ARGV[1])
+local n = tonumber(ARGV[3])
+local allowed = 1
+local counts = {}
+local buckets = {}
+
+for i = 1, n do
+    local base = 3 + (i - 1) * 3
+    local name = ARGV[base + 1]
+    local limit = tonumber(ARGV[base + 2])
+    local bucket = math.floor(now / tonumber(ARGV[base + 3]))
+    local count = 0
+    if tonumber(redis.call('HGET', key, name .. ':w')) == bucket then
+        count = tonumber(redis.call('HGET', key, name)) or 0
+    end
+    if count >= limit then
+        allowed = 0
+    end
+    counts[i] = count
+    buckets[i] = bucket
+end
+
+local result = {allowed}
+for i = 1, n do
+    local base = 3 + (i - 1) * 3
+    local name = ARGV[base + 1]
+    local limit = tonumber(ARGV[base + 2])
+    if allowed == 1 then
+        redis.call('HSET', key, name, counts[i] + 1, name .. ':w', buckets[i])
+        result[i + 1] = limit - counts[i] - 1
+    else
+        result[i + 1] = math.max(0, limit - counts[i])
+    end
+end
+
+if allowed == 1 then
+    redis.call('PEXPIRE', key, ARGV[2])
+end
+return result
+"""
+
+LUA_SCRIPTS = {
+    "sliding_window": SLIDING_WINDOW_LUA,
+    "multi_window": MULTI_WINDOW_LUA
+}
+
+# Cap on locally remembered blocked buckets (least recently blocked evicted)
+BLOCKED_CACHE_MAX_SIZE = 10_000
+
 class RateLimiter:
+    """
+    Redis-backed rate limiter.
+    Keys are "rl:{<subject hash>}:<bucket>" (see _k); the hash tag keeps every
+    key of one subject on one Redis Cluster slot so the Lua scripts stay
+    single-slot.
+    Every check is a single awaited Redis call, so its latency is dominated by
+    event-loop overhead; production runs on uvloop (see main.py) for the
+    expected characteristics.
+    """
+    
     def __init__(self, redis_url: str = None):
         self.redis_url = redis_url or settings.REDIS_URL
+        self.pool = None
         self.redis_client = None
+        self._script_shas: Dict[str, str] = {}
+        # BLAKE2b keys are limited to 64 bytes
+        self._key_secret = settings.RATE_LIMIT_KEY_SECRET.encode()[:64]
+        # Fixed-window mode needs EXPIRE ... NX (Redis 7.0+); set in connect()
+        self._sliding = settings.RATE_LIMIT_SLIDING_WINDOW
+        # bucket -> monotonic deadline until which the bucket is known blocked
+        self._blocked_until: OrderedDict[str, float] = OrderedDict()
     
     async def connect(self):
         """Connect to Redis"""
         try:
-            self.redis_client = await redis.from_url(
+            # Explicit pool so connections are reused and capped; other
+            # services can share it via rate_limiter.pool. Replies are left
+            # as bytes (every rate-limit reply is an integer), so callers
+            # reading strings must .decode() them.
+            self.pool = redis.ConnectionPool.from_url(
                 self.redis_url,
-                encoding="utf-8",
-                decode_responses=True
+                max_connections=settings.REDIS_POOL_SIZE,
+                decode_responses=False,
+                # Ping idle connections before reuse; cloud Redis drops them
+                health_check_interval=30
             )
+            self.redis_client = redis.Redis(connection_pool=self.pool)
             await self.redis_client.ping()
+            self._sliding = settings.RATE_LIMIT_SLIDING_WINDOW
+            if not self._sliding:
+                version = (await self.redis_client.info("server"))["redis_version"]
+                if int(version.split(".")[0]) < 7:
+                    logger.warning(
+                        "Redis %s lacks EXPIRE NX, using sliding window rate limits", version
+                    )
+                    self._sliding = True
+            for name, script in LUA_SCRIPTS.items():
+                self._script_shas[name] = await self.redis_client.script_load(script)
             logger.info("Connected to Redis successfully")
         except Exception as e:
-            logger.error(f"Failed to connect to Redis: {e}")
+            logger.error("Failed to connect to Redis: %s", e)
             self.redis_client = None
     
     async def close(self):
         """Close Redis connection"""
         if self.redis_client:
             await self.redis_client.close()
+        if self.pool:
+            await self.pool.disconnect()
+    
+    def _k(self, raw: str) -> str:
+        """
+        Compact Redis key for a "<bucket>:<subject>" rate-limit identifier.
+        The subject becomes a keyed 64-bit hash inside a {hash tag}, so all
+        buckets of one subject land on the same Redis Cluster slot:
+        "login:user@example.com" -> "rl:{3f1c...}:login". Collisions are
+        acceptable for rate limiting, never use this for identity.
+        """
+        bucket, _, subject = raw.partition(":")
+        if not subject:
+            bucket, subject = "", bucket
+        tag = hashlib.blake2b(subject.encode(), key=self._key_secret, digest_size=8).hexdigest()
+        return f"rl:{{{tag}}}:{bucket}" if bucket else f"rl:{{{tag}}}"
+    
+    @staticmethod
+    def _tag(key: str) -> str:
+        return key[key.index("{") + 1:key.index("}")]
+    
+    async def _eval_script(self, name: str, key: str, *args):
+        """Run a registered Lua script, reloading it if Redis lost the cache"""
+        try:
+            return await self.redis_client.evalsha(self._script_shas[name], 1, key, *args)
+        except NoScriptError:
+            # Script cache was flushed (restart/failover); EVAL also re-caches it
+            logger.warning("Rate limit script %s missing from Redis, reloading", name)
+            result = await self.redis_client.eval(LUA_SCRIPTS[name], 1, key, *args)
+            self._script_shas[name] = await self.redis_client.script_load(LUA_SCRIPTS[name])
+            return result
+    
+    @staticmethod
+    def _queue_fixed_window(pipe, key: str, window_seconds: int):
+        """Fixed-window counter: INCR, set the TTL on first hit, read the TTL back"""
+        # Own key, so switching modes never hits the sliding window's sorted set
+        key = f"{key}:fw"
+        pipe.incr(key)
+        pipe.expire(key, window_seconds, nx=True)
+        pipe.pttl(key)
+    
+    @staticmethod
+    def _fixed_window_result(count: int, ttl_ms: int, limit: int) -> Tuple[bool, int, int]:
+        if count <= limit:
+            return True, limit - count, 0
+        return False, 0, ttl_ms
+    
+    async def _incr_fixed_window(self, key: str, limit: int, window_seconds: int) -> Tuple[bool, int, int]:
+        """Run the fixed-window counter in one round-trip"""
+        pipe = self.redis_client.pipeline(transaction=False)
+        self._queue_fixed_window(pipe, key, window_seconds)
+        count, _, ttl_ms = await pipe.execute()
+        return self._fixed_window_result(count, ttl_ms, limit)
+    
+    def _remember_blocked(self, key: str, retry_after_ms: int):
+        """Reject further checks for a blocked bucket locally until its window frees up"""
+        if retry_after_ms <= 0:
+            return
+        self._blocked_until[key] = time.monotonic() + retry_after_ms / 1000
+        self._blocked_until.move_to_end(key)
+        if len(self._blocked_until) > BLOCKED_CACHE_MAX_SIZE:
+            self._blocked_until.popitem(last=False)
+    
+    def _is_blocked(self, key: str) -> bool:
+        """True if the bucket is still known to be blocked locally"""
+        blocked_until = self._blocked_until.get(key)
+        if blocked_until is None:
+            return False
+        if time.monotonic() < blocked_until:
+            return True
+        del self._blocked_until[key]
+        return False
+    
+    async def _pipeline_checks(self, keys: List[str], limit: int, window_seconds: int) -> List[Tuple[int, int, int]]:
+        """Queue one check per key and send them all in a single round-trip"""
+        sliding = self._sliding
+        now_ms = int(time.time() * 1000)
+        pipe = self.redis_client.pipeline(transaction=False)
+        for key in keys:
+            if sliding:
+                member = f"{now_ms}:{secrets.token_hex(4)}"
+                pipe.evalsha(self._script_shas["sliding_window"], 1, key, now_ms, window_seconds * 1000, limit, member)
+            else:
+                self._queue_fixed_window(pipe, key, window_seconds)
+        replies = await pipe.execute()
+        
+        if sliding:
+            return [tuple(reply) for reply in replies]
+        return [
+            self._fixed_window_result(count, ttl_ms, limit)
+            for count, ttl_ms in zip(replies[::3], replies[2::3])
+        ]
     
     async def check_rate_limit(self, key: str, limit: int, window_minutes: int = 60) -> Tuple[bool, int]:
         """
@@ -40,27 +250,99 @@ class RateLimiter:
             logger.warning("Redis not available, skipping rate limit")
             return True, limit
         
+        key = self._k(key)
+        if self._is_blocked(key):
+            return False, 0
+        
+        window_seconds = window_minutes * 60
         try:
-            current = await self.redis_client.get(key)
-            
-            if current is None:
-                # First request
-                await self.redis_client.setex(key, window_minutes * 60, 1)
-                return True, limit - 1
+            if self._sliding:
+                now_ms = int(time.time() * 1000)
+                member = f"{now_ms}:{secrets.token_hex(4)}"
+                allowed, remaining, retry_after_ms = await self._eval_script(
+                    "sliding_window", key, now_ms, window_seconds * 1000, limit, member
+                )
+            else:
+                allowed, remaining, retry_after_ms = await self._incr_fixed_window(key, limit, window_seconds)
             
-            current_count = int(current)
-            
-            if current_count >= limit:
-                return False, 0
-            
-            # Increment counter
-            await self.redis_client.incr(key)
-            return True, limit - current_count - 1
+            if not allowed:
+                self._remember_blocked(key, retry_after_ms)
+            return bool(allowed), int(remaining)
         
-        except Exception as e:
-            logger.error(f"Rate limit check failed: {e}")
+        except redis.RedisError as e:
+            logger.error("Rate limit check failed: %s", e)
             # On error, allow the request
             return True, limit
+    
+    async def check_many(self, keys: List[str], limit: int, window_minutes: int = 60) -> List[Tuple[bool, int]]:
+        """
+        Check several buckets (e.g. per-IP and per-user) in one round-trip
+        On Redis Cluster, only keys sharing a subject share a slot; the
+        pipeline is ordered by hash tag so the client can split it per node.
+        Returns: [(is_allowed, remaining_attempts), ...] in the order of keys
+        """
+        if not self.redis_client:
+            # If Redis is not available, allow all requests
+            logger.warning("Redis not available, skipping rate limit")
+            return [(True, limit)] * len(keys)
+        
+        keys = [self._k(key) for key in keys]
+        results: List[Tuple[bool, int]] = [(False, 0)] * len(keys)
+        pending = [i for i, key in enumerate(keys) if not self._is_blocked(key)]
+        if not pending:
+            return results
+        
+        window_seconds = window_minutes * 60
+        # Keep same-slot keys adjacent so a cluster pipeline batches per node
+        pending.sort(key=lambda i: self._tag(keys[i]))
+        pending_keys = [keys[i] for i in pending]
+        try:
+            try:
+                replies = await self._pipeline_checks(pending_keys, limit, window_seconds)
+            except NoScriptError:
+                # Nothing ran; reload the script and retry once
+                logger.warning("Rate limit script missing from Redis, reloading")
+                self._script_shas["sliding_window"] = await self.redis_client.script_load(SLIDING_WINDOW_LUA)
+                replies = await self._pipeline_checks(pending_keys, limit, window_seconds)
+        except redis.RedisError as e:
+            logger.error("Rate limit check failed: %s", e)
+            # On error, allow the requests
+            for i in pending:
+                results[i] = (True, limit)
+            return results
+        
+        for i, (allowed, remaining, retry_after_ms) in zip(pending, replies):
+            if not allowed:
+                self._remember_blocked(keys[i], retry_after_ms)
+            results[i] = (bool(allowed), int(remaining))
+        return results
+    
+    async def check_multi(self, user: str, specs: List[Tuple[str, int, int]]) -> Tuple[bool, List[int]]:
+        """
+        Check several fixed windows for one subject in a single atomic call,
+        e.g. specs=[("m", 5, 60), ("h", 20, 3600)] as (name, limit, window_seconds)
+        Returns: (is_allowed, remaining_attempts per spec)
+        """
+        if not self.redis_client:
+            # If Redis is not available, allow all requests
+            logger.warning("Redis not available, skipping rate limit")
+            return True, [limit for _, limit, _ in specs]
+        if not specs:
+            return True, []
+        
+        args = [int(time.time() * 1000), max(window for _, _, window in specs) * 1000, len(specs)]
+        for name, limit, window_seconds in specs:
+            args.extend((name, limit, window_seconds * 1000))
+        
+        try:
+            # Own bucket: the hash must not share a key with check_rate_limit's counters
+            allowed, *remaining = await self._eval_script("multi_window", self._k(f"multi:{user}"), *args)
+            return bool(allowed), [int(r) for r in remaining]
+        
+        except redis.RedisError as e:
+            logger.error("Rate limit check failed: %s", e)
+            # On error, allow the request
+            return True, [limit for _, limit, _ in specs]
 
 # Global rate limiter instance
 rate_limiter = RateLimiter()
\ No newline at end of file
@@ -0,0 +1,69 @@
+"""
+RateLimiter.check_multi against a real Redis (REDIS_URL, default
+redis://localhost:6379, e.g. from docker-compose). Skipped if Redis is down.
+"""
+import asyncio
+import os
+import secrets
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "backend"))
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "test_database")
+
+from services import rate_limiter as rate_limiter_module  # noqa: E402
+from services.rate_limiter import RateLimiter  # noqa: E402
+
+SPECS = [("m", 2, 60), ("h", 3, 3600)]
+
+
+def run_with_limiter(scenario):
+    """Run scenario(limiter) on a connected limiter in one event loop"""
+    async def main():
+        limiter = RateLimiter(os.environ.get("REDIS_URL", "redis://localhost:6379"))
+        await limiter.connect()
+        if not limiter.redis_client:
+            pytest.skip("Redis not available")
+        try:
+            await scenario(limiter)
+        finally:
+            await limiter.close()
+    asyncio.run(main())
+
+
+def test_check_multi_is_all_or_nothing_and_rolls_over(monkeypatch):
+    user = f"test:{secrets.token_hex(8)}"
+    # Start of an hour, so the minute and hour windows roll over predictably
+    start = (int(rate_limiter_module.time.time()) // 3600 + 1) * 3600
+
+    async def scenario(limiter):
+        async def check_at(now):
+            monkeypatch.setattr(rate_limiter_module.time, "time", lambda: now)
+            return await limiter.check_multi(user, SPECS)
+
+        try:
+            assert await check_at(start) == (True, [1, 2])
+            assert await check_at(start + 1) == (True, [0, 1])
+            # Minute window is full; the hour window must not be charged for it
+            assert await check_at(start + 2) == (False, [0, 1])
+
+            # Next minute: the minute window rolls over, the hour window does not
+            assert await check_at(start + 60) == (True, [1, 0])
+            assert await check_at(start + 61) == (False, [1, 0])
+
+            # Next hour: both windows start over
+            assert await check_at(start + 3600) == (True, [1, 2])
+        finally:
+            await limiter.redis_client.delete(limiter._k(f"multi:{user}"))
+
+    run_with_limiter(scenario)
+
+
+def test_check_multi_without_specs_allows():
+    async def scenario(limiter):
+        assert await limiter.check_multi("test:nobody", []) == (True, [])
+
+    run_with_limiter(scenario)